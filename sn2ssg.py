@@ -1,37 +1,69 @@
 #!/usr/bin/env python3
-import fnmatch
+import functools
 import os
 import re
 import shutil
 import subprocess
 import sys
 import time
+from collections.abc import Iterable, Iterator
 from datetime import datetime
 
 import requests
 
-SN_HEADER_PATTERN = r"^\|\s*(.*?):\s*(.*?)\s*\|"
-IGNORED_TAGS = [os.environ.get("TAG_TO_DOWNLOAD"), "blog"]
-
-
-def _trash_sncli_log(input_lines: [str]) -> [str]:
-    log_entries_to_remove = [
-        "sncli database doesn't exist",
-        "Starting full sync",
-        "Synced new note from server",
-        "Saved note to disk",
-        "Full sync completed",
-    ]
-    output_lines = list(
-        filter(
-            lambda s: "" in s and not any(x in s for x in log_entries_to_remove),
-            input_lines.split("\n"),
-        )
-    )
-    return output_lines
+SLUG_STRIP_RE = re.compile(r"[^\w\s-]")
+SLUG_DASH_RE = re.compile(r"[ -]+")
+TEMPLATE_FIELD_RE = re.compile(r"\{\{(\w+)\}\}")
+SN_DATE_MONTHS = {
+    "Jan": "01",
+    "Feb": "02",
+    "Mar": "03",
+    "Apr": "04",
+    "May": "05",
+    "Jun": "06",
+    "Jul": "07",
+    "Aug": "08",
+    "Sep": "09",
+    "Oct": "10",
+    "Nov": "11",
+    "Dec": "12",
+}
+TAG_TO_DOWNLOAD = os.environ.get("TAG_TO_DOWNLOAD")
+SSG_TYPE = os.environ.get("SSG_TYPE")
+AUTHOR = os.environ.get("AUTHOR", "root")
+INPUT_DIR = os.environ.get("INPUT_DIR")
+OUTPUT_DIR = os.environ.get("OUTPUT_DIR")
+IGNORED_TAGS = frozenset(tag for tag in (TAG_TO_DOWNLOAD, "blog") if tag)
+# reuse one connection pool for notifications, and don't let a stuck
+# Gotify server hold up the polling cycle
+GOTIFY_SESSION = requests.Session()
+GOTIFY_TIMEOUT = 5
+SNCLI_LOG_ENTRIES_TO_REMOVE = (
+    "sncli database doesn't exist",
+    "Starting full sync",
+    "Synced new note from server",
+    "Saved note to disk",
+    "Full sync completed",
+)
+
+
+def _trash_sncli_log(input_lines: Iterable[str]) -> Iterator[str]:
+    # input_lines is read lazily (e.g. straight from sncli's stdout) so the
+    # whole dump never has to be held in memory at once
+    line = "\n"
+    for line in input_lines:
+        # plain for/else rather than any(...), which would build a generator per line
+        for log_entry in SNCLI_LOG_ENTRIES_TO_REMOVE:
+            if log_entry in line:
+                break
+        else:
+            yield line.removesuffix("\n")
+    # like str.split("\n"), end with an empty line if the input ended with a newline
+    if line.endswith("\n"):
+        yield ""
 
 
-def _gather_header_info(pattern: str, note: [str]) -> tuple[str, str, [str]]:
+def _gather_header_info(note: [str]) -> tuple[str, str, [str]]:
     """
     header info we care about: title, date, tags without the one we filtered all notes for
     """
@@ -39,10 +71,15 @@ def _gather_header_info(pattern: str, note: [str]) -> tuple[str, str, [str]]:
     date = ""
     tags = []
     for line in note:
-        match = re.match(pattern, line)
-        if match:
-            key = match.group(1).strip()
-            value = match.group(2).strip()
+        # header lines look like "| Key: value    |", split them with plain
+        # str.partition rather than a regex since this runs on every header line
+        if not line.startswith("|"):
+            continue
+        key, colon, rest = line[1:].partition(":")
+        value, bar, _ = rest.partition("|")
+        if colon and bar:
+            key = key.strip()
+            value = value.strip()
             if key == "Title":
                 title = value.replace("#", "")
             elif key == "Date":
@@ -50,22 +87,18 @@ def _gather_header_info(pattern: str, note: [str]) -> tuple[str, str, [str]]:
             elif key == "Tags":
                 for item in value.split(","):
                     tags.append(item)
+            # everything after the fields we care about is of no use to us
+            if title and date and tags:
+                break
     return title, date, tags
 
 
-def _convert_title_to_filename(title: str) -> str:
-    return _convert_title_to_slug(title) + ".md"
-
-
 def _convert_title_to_slug(title: str) -> str:
     # Remove special characters, keep only alphanumeric and whitespace
-    slug = re.sub(r"[^\w\s-]", "", title)
-
-    # Replace whitespace with "-"
-    slug = slug.strip().replace(" ", "-")
+    slug = SLUG_STRIP_RE.sub("", title)
 
-    # Replace consecutive "-" with a single "-"
-    slug = re.sub(r"[-]+", "-", slug)
+    # Replace each run of spaces and/or "-" with a single "-"
+    slug = SLUG_DASH_RE.sub("-", slug.strip())
 
     # Convert to lowercase
     slug = slug.lower()
@@ -73,41 +106,28 @@ def _convert_title_to_slug(title: str) -> str:
     return slug
 
 
-def _split_notes(input_lines: [str]) -> [[str]]:
+def _split_notes(input_lines: Iterable[str]) -> Iterator[[str]]:
     # uses "ending" header (ends with "-+") lines as delimiters between notes
-    output_notes = []
+    # state 0: before the first header, 1: inside a header, 2: inside a note body
     note = []
-    header_start_found = False
-    header_end_found = False
+    append = note.append
+    state = 0
     for line in input_lines:
-        if (
-            line.endswith("-+")
-            and header_start_found is True
-            and header_end_found is True
-        ):
-            # add current temp note to list of notes
-            output_notes.append(note)
-            # cut a new note
-            note = []
-            header_start_found = True
-            header_end_found = False
-            note.append(line)
-        else:
-            if line.endswith("-+") and header_start_found is False:
-                header_start_found = True
-            elif (
-                line.endswith("-+")
-                and header_start_found is True
-                and header_end_found is False
-            ):
-                header_end_found = True
-            # add line to current temp note
-            note.append(line)
+        if line.endswith("-+"):
+            if state == 2:
+                # hand off current temp note and cut a new note
+                yield note
+                note = []
+                append = note.append
+                state = 1
+            else:
+                state += 1
+        # add line to current temp note
+        append(line)
 
     # since we're basing spitting of notes on headers, we won't have a way to store the last note
-    # so explicitly store the last note
-    output_notes.append(note)
-    return output_notes
+    # so explicitly hand off the last note
+    yield note
 
 
 def _delete_existing_title(note: [str]) -> [str]:
@@ -119,102 +139,137 @@ def _delete_existing_title(note: [str]) -> [str]:
         return note
 
 
-def _delete_existing_header(note: [str]) -> [str]:
-    # trash "starting" header and "middle" header lines
-    output_note = []
+def _partition_note(note: [str]) -> tuple[[str], [str]]:
+    # split "starting" header and "middle" header lines from the note's body
+    # in a single pass, so neither has to be re-scanned for the other
+    header = []
+    body = []
     for line in note:
-        if (
-            not line.startswith("|")
-            and not line.endswith("|")
-            and not line.startswith("+-")
-        ):
-            output_note.append(line)
-    return output_note
+        if line.startswith(("|", "+-")) or line.endswith("|"):
+            header.append(line)
+        else:
+            body.append(line)
+    return header, body
 
 
 def _convert_date_format(input_date: str) -> str:
     # convert input_date from format: Fri, 01 Sep 2023 02:33:35
     # to format: 2018-07-25T03:25:58+00:00
+    # sncli always writes this fixed-width format, so slice it directly
+    # and only fall back to strptime for anything unexpected
+    month = SN_DATE_MONTHS.get(input_date[8:11])
+    if month and len(input_date) == 25:
+        return (
+            f"{input_date[12:16]}-{month}-{input_date[5:7]}T{input_date[17:25]}+00:00"
+        )
     return datetime.strptime(input_date, "%a, %d %b %Y %H:%M:%S").strftime(
         "%Y-%m-%dT%H:%M:%S+00:00"
     )
 
 
-def _create_ssg_header(
-    ssg_type: str, title: str, subtitle: str, author: str, date: str, tags: [str]
-) -> [str]:
+@functools.lru_cache
+def _load_template(ssg_type: str) -> tuple[str, ...]:
+    # every note uses the same template, so only read it from disk once
+    # and split it into alternating literal text and "{{field}}" names
     with open(f"templates/{ssg_type}.md") as template_file:
-        template = template_file.read()
+        return tuple(TEMPLATE_FIELD_RE.split(template_file.read()))
 
-    try:
-        # Replace template fields with user input
-        template = template.replace("{{title}}", title)
-        template = template.replace("{{subtitle}}", subtitle)
-        template = template.replace("{{author}}", author)
-        template = template.replace("{{date}}", date)
-        template = template.replace("{{slug}}", _convert_title_to_slug(title))
-
-        # don't template the "tag" field with the meta-tag TAG_TO_DOWNLOAD
-        # either use the next tag, or set as "Uncategorized"
-        if (
-            isinstance(tags, list)
-            and all(isinstance(item, str) for item in tags)
-            and len(tags) > 1
-        ):
-            for tag in tags:
-                if tag not in IGNORED_TAGS:
-                    template = template.replace("{{tag}}", tag)
-        else:
-            template = template.replace("{{tag}}", "Uncategorized")
 
-    except:
-        print("Field missing when templating SSG header, carrying on!")
+def _create_ssg_header(
+    ssg_type: str,
+    title: str,
+    slug: str,
+    subtitle: str,
+    author: str,
+    date: str,
+    tags: [str],
+) -> [str]:
+    template_parts = _load_template(ssg_type)
+
+    # don't template the "tag" field with the meta-tag TAG_TO_DOWNLOAD
+    # either use the next tag, or set as "Uncategorized"
+    if len(tags) > 1:
+        tag = next((tag for tag in tags if tag not in IGNORED_TAGS), "Uncategorized")
+    else:
+        tag = "Uncategorized"
+
+    fields = {
+        "title": title,
+        "subtitle": subtitle,
+        "author": author,
+        "date": date,
+        "slug": slug,
+        "tag": tag,
+    }
+
+    # Replace template fields with user input in a single pass,
+    # leaving any fields we don't know about untouched
+    template = list(template_parts)
+    template[1::2] = [
+        fields.get(name, "{{" + name + "}}") for name in template_parts[1::2]
+    ]
 
-    return [x for x in template.split("\n")]
+    return "".join(template).split("\n")
 
 
-def _prepend_ssg_header(new_header: [str], note: [str]) -> [str]:
-    output_note = []
-    for line in new_header + note:
-        output_note.append(line + "\n")
-    return output_note
+def _prepend_ssg_header(new_header: [str], note: [str]) -> str:
+    return "\n".join(new_header + note) + "\n"
 
 
 def _write_note_file(
-    output_markdown: [str],
+    output_markdown: str,
     output_dir: str,
     output_filename: str,
     notes_output_counter: int,
 ):
+    output_path = f"{output_dir}/{output_filename}"
+    # Skip notes which haven't changed since the last cycle, so the SSG isn't
+    # handed a freshly modified file to rebuild for nothing. Comparing sizes
+    # first means only files which might be identical are read back
+    if os.path.isfile(output_path) and os.path.getsize(output_path) == len(
+        output_markdown.encode()
+    ):
+        with open(output_path) as existing_file:
+            if existing_file.read() == output_markdown:
+                return notes_output_counter + 1
+
     # Write the resulting markdown to a file
-    with open(f"{output_dir}/{output_filename}", "w") as output_file:
-        for line in output_markdown:
-            output_file.write(line)
+    with open(output_path, "w") as output_file:
+        output_file.write(output_markdown)
     return notes_output_counter + 1
 
 
+def _count_output_files(output_dir: str) -> int:
+    # count files with an extension, without globbing the whole directory listing
+    with os.scandir(output_dir) as entries:
+        return sum(1 for entry in entries if "." in entry.name and entry.is_file())
+
+
 def _ensure_num_parsed_notes_matches_outputted_notes(
-    notes: [[str]], notes_output_counter: int, start_counter: int, end_counter: int
+    notes_parsed_counter: int,
+    notes_output_counter: int,
+    start_counter: int,
+    end_counter: int,
 ) -> int:
-    if len(notes) != notes_output_counter or end_counter < start_counter:
+    if notes_parsed_counter != notes_output_counter or end_counter < start_counter:
         title = "sn2ssg FATAL error"
-        message = f"FATAL: The number of notes ({len(notes)}) does not match the number of outputted files ({notes_output_counter})"
+        message = f"FATAL: The number of notes ({notes_parsed_counter}) does not match the number of outputted files ({notes_output_counter})"
         print(message)
         _send_gotify_notification(title, message)
         sys.exit(1)
     elif os.environ.get("DEBUG") == "True":
         title = "sn2ssg successful"
-        message = (
-            f"DEBUG: Number of parsed vs outputted notes matches: {len(notes)} notes"
-        )
+        message = f"DEBUG: Number of parsed vs outputted notes matches: {notes_parsed_counter} notes"
         print(message)
         _send_gotify_notification(title, message)
     else:
-        message = f"Number of parsed vs outputted notes matches: {len(notes)} notes"
+        message = (
+            f"Number of parsed vs outputted notes matches: {notes_parsed_counter} notes"
+        )
         print(message)
 
 
-def _run_sncli(tag_to_download: str, input_filename: str):
+def _run_sncli(tag_to_download: str, dump_filename: str) -> Iterator[str]:
     # Define the command as a list of strings
     sncli_binary_path = shutil.which("sncli")
 
@@ -224,13 +279,21 @@ def _run_sncli(tag_to_download: str, input_filename: str):
 
     command = [sncli_binary_path, "--config=/dev/null", "-r", "dump", tag_to_download]
 
-    # Execute the command
-    try:
-        with open(input_filename, "w") as output:
-            subprocess.run(command, stdout=output, check=True, text=True)
+    # Execute the command, handing its output straight to the caller line by line
+    # rather than writing the dump to disk and reading it back.
+    # Only keep a copy of the dump on disk when debugging
+    with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as sncli:
+        if os.environ.get("DEBUG") == "True":
+            with open(dump_filename, "w") as dump_file:
+                for line in sncli.stdout:
+                    dump_file.write(line)
+                    yield line
+        else:
+            yield from sncli.stdout
+    if sncli.returncode != 0:
+        print(f"Error: {subprocess.CalledProcessError(sncli.returncode, command)}")
+    else:
         print("Dumping of notes via sncli was successful.")
-    except subprocess.CalledProcessError as e:
-        print(f"Error: {e}")
 
 
 def _send_gotify_notification(notification_title: str, notification_text: str):
@@ -243,57 +306,67 @@ def _send_gotify_notification(notification_title: str, notification_text: str):
         return
     params = {"token": os.environ.get("GOTIFY_TOKEN")}
     data = {"title": notification_title, "message": notification_text}
-    response = requests.post(url, params=params, data=data)
+    try:
+        response = GOTIFY_SESSION.post(
+            url, params=params, data=data, timeout=GOTIFY_TIMEOUT
+        )
+    except requests.RequestException as e:
+        print(f"Error: {e}")
+        return
     print(response.text)
 
 
-def main():
-    try:
-        os.mkdir(os.environ.get("INPUT_DIR"))
-        os.mkdir(os.environ.get("OUTPUT_DIR"))
-    except FileExistsError:
-        print("Input / Output directories already exist")
-    output_dir_num_files_start = len(
-        fnmatch.filter(os.listdir(os.environ.get("OUTPUT_DIR")), "*.*")
+def _process_note(
+    note: [str], header_info: tuple[str, str, [str]], notes_output_counter: int
+) -> int:
+    # note only holds the body, the header lines were already split off into header_info
+    title, date, tags = header_info
+    subtitle = ""
+    date = _convert_date_format(date)
+    # the slug is used for both the header and the filename, so only build it once
+    slug = _convert_title_to_slug(title)
+    new_header = _create_ssg_header(SSG_TYPE, title, slug, subtitle, AUTHOR, date, tags)
+    note = _delete_existing_title(note)
+    note = _prepend_ssg_header(new_header, note)
+    return _write_note_file(
+        note,
+        OUTPUT_DIR,
+        slug + ".md",
+        notes_output_counter,
     )
-    input_filename = f"{os.environ.get('INPUT_DIR')}/sn_dump.md"
-    _run_sncli(os.environ.get("TAG_TO_DOWNLOAD"), input_filename)
-    with open(input_filename) as input_file:
-        input_lines = input_file.read()
-    input_lines = _trash_sncli_log(input_lines)
-    notes = _split_notes(input_lines)
+
+
+def _sync_notes():
+    output_dir_num_files_start = _count_output_files(OUTPUT_DIR)
+    dump_filename = f"{INPUT_DIR}/sn_dump.md"
+    notes_parsed_counter = 0
     notes_output_counter = 0
-    for note in notes:
-        title, date, tags = _gather_header_info(SN_HEADER_PATTERN, note)
-        note = _delete_existing_header(note)
-        subtitle = ""
-        author = os.environ.get("AUTHOR", "root")
-        date = _convert_date_format(date)
-        new_header = _create_ssg_header(
-            os.environ.get("SSG_TYPE"), title, subtitle, author, date, tags
-        )
-        note = _delete_existing_title(note)
-        note = _prepend_ssg_header(new_header, note)
-        notes_output_counter = _write_note_file(
-            note,
-            os.environ.get("OUTPUT_DIR"),
-            _convert_title_to_filename(title),
-            notes_output_counter,
+    sncli_lines = _run_sncli(TAG_TO_DOWNLOAD, dump_filename)
+    for note in _split_notes(_trash_sncli_log(sncli_lines)):
+        notes_parsed_counter += 1
+        header, body = _partition_note(note)
+        notes_output_counter = _process_note(
+            body, _gather_header_info(header), notes_output_counter
         )
-    output_dir_num_files_end = len(
-        fnmatch.filter(os.listdir(os.environ.get("OUTPUT_DIR")), "*.*")
-    )
+    output_dir_num_files_end = _count_output_files(OUTPUT_DIR)
     _ensure_num_parsed_notes_matches_outputted_notes(
-        notes,
+        notes_parsed_counter,
         notes_output_counter,
         output_dir_num_files_start,
         output_dir_num_files_end,
     )
-    os.remove(input_filename)
+
+
+def main():
+    os.makedirs(INPUT_DIR, exist_ok=True)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
     time_to_sleep = int(os.environ.get("POLLING_CYCLE", 3600))
-    print(f"sn2ssg ran successfully! Sleeping {time_to_sleep} before next cycle.")
-    time.sleep(time_to_sleep)
-    return
+    # keep polling in this process rather than exiting after each cycle,
+    # so the cached template and interpreter start-up carry over between cycles
+    while True:
+        _sync_notes()
+        print(f"sn2ssg ran successfully! Sleeping {time_to_sleep} before next cycle.")
+        time.sleep(time_to_sleep)
 
 
 if __name__ == "__main__":